@@ -10,10 +10,13 @@ usage: arbophyl [-h] -i INPUT -o OUTPUT -p PIPELINE
 
 """Import Statements"""
 import os
-import re
 import sys
 import glob
-from Bio import SeqIO
+import mmap
+import functools
+import itertools
+import collections
+import concurrent.futures
 
 
 """Authorship Information"""
@@ -28,50 +31,156 @@ __email__ = "t.verschuren@wi.knaw.nl"
 __status__ = "Development"
 
 
+# Rendered progress bars for each percentage and the last displayed state
+# of the progress bar
+_bars = ['█' * percent + '-' * (100 - percent) for percent in range(101)]
+_progress_state = {"last": None}
+
+
 def progress_bar(progress: int, total: int):
-    """Progress bar displaying progress of ongoing analysis.
+    """Progress bar displaying progress of ongoing analysis. The bar is only
+    printed when the displayed percentage changes.
 
     Args:
         progress (int): Current increment.
         total (int): Total number of increments.
     """
     percent = 100 * (progress / float(total))
-    bar = '█' * int(percent) + '-' * (100 - int(percent))
-    print(f"\r Progress: |{bar}| {round(percent)}%", end = "\r")
+    state = (int(percent), round(percent))
+    # Always print the first increment of an analysis
+    if progress > 1 and state == _progress_state["last"]:
+        return
+    _progress_state["last"] = state
+    print(f"\r Progress: |{_bars[state[0]]}| {state[1]}%", end = "\r",
+          flush=True)
 
 
-def read_fasta(fasta_file: str) -> str:
-    """Read content of fasta file and store sequence as string.
+def read_fasta(fasta_file: str) -> bytes:
+    """Read content of fasta file and store sequence as bytes.
 
     Attributes:
         fasta_file (str): Path to the fasta file.
 
     Returns:
-        seq (str): String containing sequence present in fasta file.
+        seq (bytes): Bytes containing sequence present in fasta file.
     """
-    for record in SeqIO.parse(fasta_file, "fasta"):
-        seq = str(record.seq).upper()
+    # Map the file into memory, only the sequence is copied from it
+    with open(fasta_file, "rb") as handle, \
+         mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # Sequence runs from the end of the header line up to the next record
+        start = data.find(b"\n") + 1
+        end = data.find(b"\n>", start)
+        if end == -1:
+            end = len(data)
+        seq = data[start:end].translate(None, b" \r\n").upper()
 
     return seq
 
 
-def auto_linebreak(string: str) -> str:
-    """Automatically line break string at 60 characters.
+@functools.lru_cache(maxsize=None)
+def _read_seq(fasta_file: str) -> bytes:
+    """Cached version of read_fasta, used while filtering BUSCOs.
 
     Args:
-        string (str): String to be broken
+        fasta_file (str): Path to the fasta file.
 
     Returns:
-        str: Line broken string
+        bytes: Bytes containing sequence present in fasta file.
+    """
+    return read_fasta(fasta_file)
+
+
+@functools.lru_cache(maxsize=None)
+def _seq_len(fasta_file: str) -> int:
+    """Cached length of the sequence in a fasta file.
+
+    Args:
+        fasta_file (str): Path to the fasta file.
+
+    Returns:
+        int: Number of residues in the sequence present in fasta file.
+    """
+    return len(_read_seq(fasta_file))
+
+
+def auto_linebreak(string: bytes) -> bytes:
+    """Automatically line break sequence at 60 characters.
+
+    Args:
+        string (bytes): Sequence to be broken
+
+    Returns:
+        bytes: Line broken sequence
+    """
+    # Slice in steps of 60, the range includes len(string) to keep the
+    # trailing line break after a completely filled last line
+    return b"\n".join(string[i:i + 60] for i in range(0, len(string) + 1, 60))
+
+
+# State of filter_BUSCOs shared with its worker processes
+_filter_state = {}
+
+
+def _init_filter(gene_index: dict, species: list, path: str, 
+                 mode: str) -> None:
+    """Store the settings required by _write_gene in a worker process.
+
+    Args:
+        gene_index (dict): Dictionary with BUSCO genes as the key and a 
+        dictionary of species and paths as its value.
+        species (list): List containing all analysed species.
+        path (str): File path to output folder of filtered BUSCOs.
+        mode (str): Analysis mode (genome, proteins).
+    """
+    _filter_state["gene_index"] = gene_index
+    # Encode the header of each species once for all genes
+    _filter_state["headers"] = {name: f">{name}\n".encode() \
+                                for name in species}
+    _filter_state["path"] = path
+    _filter_state["mode"] = mode
+
+
+def _write_gene(gene: str) -> None:
+    """Write each species' copy of one BUSCO gene to a fasta file.
+
+    Args:
+        gene (str): File name of the BUSCO gene.
     """
-    return re.sub("(.{60})", "\\1\n", string, 0, re.DOTALL)
+    # Determine analysis mode
+    if _filter_state["mode"] == "genome":
+        MS_file = gene.replace('.fna', '_MS.fna')
+    elif _filter_state["mode"] == "proteins":
+        MS_file = gene.replace('.faa', '_MS.faa')
+
+    # Species which have fasta files available
+    species_with = _filter_state["gene_index"][gene]
+    # Gap sequence for missing species, based on the sequence length of the
+    # first species possessing the gene
+    gap = auto_linebreak(b"-"*_seq_len(next(iter(species_with.values()))))
+
+    # For each species, write shared gene sequence to file
+    with open(f"{_filter_state['path']}{MS_file}", "wb", 
+              buffering=1 << 20) as MS_fasta:
+        for species, header in _filter_state["headers"].items():
+            if species in species_with:
+                # Break line at 60 characters
+                seq = auto_linebreak(_read_seq(species_with[species]))
+            # If gene sequence not avaiable, replace with gaps
+            else:
+                seq = gap
+            # Write record to file
+            MS_fasta.write(header + seq + b"\n")
+
+    # Each sequence belongs to a single gene, release cache
+    _read_seq.cache_clear()
+    _seq_len.cache_clear()
 
 
 class ap_analyses:
     """Class containing non-conda based analyses for ArboPhyl.
     """
     def __init__(self, input= "", output="", mode="", pipeline="", 
-                 lineage="", shared=100., complete=0.) -> None:
+                 lineage="", shared=100., complete=0., threads=None) -> None:
         """Read the input settings of non-conda based analyses for ArboPhyl.
 
         Args:
@@ -84,6 +193,8 @@ class ap_analyses:
             shared (float, optional): Percentage of BUSCO genes that need to be 
             shared.
             complete (float, optional): Minimum BUSCO completeness of genomes.
+            threads (int, optional): Number of processes used to filter 
+            BUSCOs, defaults to the number of CPUs.
         """
         self.input = input
         self.output = output
@@ -92,6 +203,7 @@ class ap_analyses:
         self.lineage = lineage
         self.shared = shared
         self.complete = complete
+        self.threads = threads
 
     def get_BUSCOs(self) -> dict:
         """Retrieve paths of present BUSCO genes for each analysed species
@@ -111,17 +223,17 @@ class ap_analyses:
 
         # Get path of BUSCO outputs and create list of folders
         path = f"{self.output}BUSCO_output/"
-        folders = os.listdir(path)
-        # Get list of present single copy busco genes per analysed species
-        for progress, folder in enumerate(folders, 1):
-            buscos_dict[folder] = []
-            # For each file that matches wildcards, add filepath to dict
-            for file in os.listdir(glob.glob(
-                f"{path}/{folder}/*_odb10/busco*/single*")[0]):
-                if file.endswith(extention):
-                    buscos_dict[folder].append(glob.glob(
-                    f"{path}/{folder}/*_odb10/busco*/single*/{file}")[0])
-            progress_bar(progress, len(folders))
+        folders = self._list_folders(path)
+        # Get list of present single copy busco genes per analysed species,
+        # scanning the folders concurrently as this is bound by file system
+        # latency
+        with concurrent.futures.ThreadPoolExecutor(max_workers=32) \
+            as executor:
+            scans = executor.map(functools.partial(
+                self._scan_folder, path, extention=extention), folders)
+            for progress, (folder, files) in enumerate(scans, 1):
+                buscos_dict[folder] = files
+                progress_bar(progress, len(folders))
         print("\n")
 
         # Remove genomes with low completeness
@@ -131,6 +243,42 @@ class ap_analyses:
 
         return buscos_dict
 
+    @staticmethod
+    def _list_folders(path: str) -> list:
+        """List the folders within an output folder, such as the BUSCO
+        output folders of the analysed species or the model folders.
+
+        Args:
+            path (str): File path to the output folder.
+
+        Returns:
+            list: Names of the folders, skipping files and hidden entries
+        """
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries \
+                    if entry.is_dir() and not entry.name.startswith(".")]
+
+    @staticmethod
+    def _scan_folder(path: str, folder: str, extention: str) -> tuple:
+        """Retrieve paths of single copy BUSCO genes of one species.
+
+        Args:
+            path (str): File path to BUSCO output folder.
+            folder (str): Name of the BUSCO output folder of the species.
+            extention (str): File extention of the BUSCO genes.
+
+        Returns:
+            tuple: Name of the folder and a list of paths to BUSCO genes
+        """
+        # Locate the single copy BUSCO folder once and add the path of each
+        # file with a matching extention
+        sc_dir = glob.glob(f"{path}/{folder}/*_odb10/busco*/single*")[0]
+        with os.scandir(sc_dir) as entries:
+            files = [entry.path for entry in entries \
+                     if entry.name.endswith(extention)]
+
+        return folder, files
+
     @staticmethod
     def get_Overlap(busco_dict: dict) -> dict:
         """Calculate the percentage of species which possess specific 
@@ -144,17 +292,13 @@ class ap_analyses:
             dict: Dictionary containing the percentage of species which posses 
             a BUSCO gene as values and the BUSCO genes as keys.
         """
-        overlap = {}
         # Count occurence of each BUSCO gene
-        for value in busco_dict.values():
-            for gene in value:
-                if gene.split("/")[-1] in overlap:
-                    overlap[gene.split("/")[-1]] += 1
-                else:
-                    overlap[gene.split("/")[-1]] = 1
+        counts = collections.Counter(gene.rsplit("/", 1)[-1] \
+                                     for value in busco_dict.values() \
+                                     for gene in value)
         # Calculate percentage of species that possess BUSCO gene
-        overlap = {k: round(v / len(busco_dict)*100, 1) \
-                   for k, v in overlap.items()}
+        total = len(busco_dict)
+        overlap = {k: round(v / total*100, 1) for k, v in counts.items()}
         return overlap
 
     def filter_BUSCOs(self, overlap: dict, buscos: dict) -> None:
@@ -169,11 +313,12 @@ class ap_analyses:
             key and a list of paths as its value
         """
         # Check if any gene matches the shared percentage, else exit analysis.
-        if any(perc >= self.shared for perc in overlap.values()) == False:
+        highest = max(overlap.values())
+        if highest < self.shared:
             sys.exit(f"\033[1;31mWARNING: No BUSCOs detected that matched the"\
                         f" submitted shared percentage ({self.shared}%), "\
                         f"please lower shared percentage to at least "\
-                        f"{max(overlap.values())}%.\033[00m\n")
+                        f"{highest}%.\033[00m\n")
         
         print("Filtering BUSCOs...\n")
         # Path to output locations
@@ -181,50 +326,26 @@ class ap_analyses:
         # Create output folder
         os.makedirs(os.path.dirname(path), exist_ok=True)
 
+        # Index the path of each BUSCO gene per species
+        gene_index = collections.defaultdict(dict)
+        for species, busco_list in buscos.items():
+            for paths in busco_list:
+                gene_index[paths.rsplit("/", 1)[-1]][species] = paths
+
+        # Only pass genes matching the shared percentage to the workers
+        passed = {gene: gene_index[gene] for gene, value in overlap.items() \
+                  if value >= self.shared}
+
         # Per passed gene, create a fasta file containing the shared
         # sequences between each species
-        for progress, (gene, value) in enumerate(overlap.items(), 1):
-            present_dict = {}
-            if value >= self.shared:
-                # Determine analysis mode
-                if self.mode == "genome":
-                    MS_file = gene.split("/")[-1].replace('.fna', '_MS.fna')
-                elif self.mode == "proteins":
-                    MS_file = gene.split("/")[-1].replace('.faa', '_MS.faa')
-
-                # Determine which species have fasta files available
-                for species, busco_list in buscos.items():
-                    if any(paths.endswith(gene) for paths in busco_list) \
-                        == True:
-                        present_dict[species] = True
-                    else:
-                        present_dict[species] = False
-
-            # For each species, write shared gene sequence to file
-            if len(present_dict) > 0:
-                with open(f"{path}{MS_file}", "w") as MS_fasta:
-                    for species, bool_val in present_dict.items():
-                        if bool_val == True:
-                            for paths in buscos[species]:
-                                if paths.split("/")[-1] == gene:
-                                    # Write sequence to file. Break line at 
-                                    # 60 characters
-                                    MS_fasta.write(f">{species}\n")
-                                    MS_fasta.write(auto_linebreak(
-                                                   read_fasta(paths)))
-                                    MS_fasta.write("\n")
-                        # If gene sequence not avaiable, replace with gaps
-                        else:
-                            for paths in buscos[list(present_dict.keys())\
-                                    [list(present_dict.values()).index(True)]]:
-                                if paths.split("/")[-1] == gene:
-                                    gap = "-"*len(read_fasta(paths))
-                                    # Write sequence to file. Break line at 
-                                    # 60 characters
-                                    MS_fasta.write(f">{species}\n")
-                                    MS_fasta.write(auto_linebreak(gap))
-                                    MS_fasta.write("\n")
-            progress_bar(progress, len(overlap))
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.threads, initializer=_init_filter,
+            initargs=(passed, list(buscos), path, self.mode)) as executor:
+            futures = [executor.submit(_write_gene, gene) for gene in passed]
+            for progress, future in enumerate(
+                concurrent.futures.as_completed(futures), 1):
+                future.result()
+                progress_bar(progress, len(futures))
         print("\n")
 
     def create_partition(self) -> None:
@@ -234,6 +355,9 @@ class ap_analyses:
 
         model_dict = {}
         path = f"{self.output}/Models/"
+        # List model folders once, each is visited twice by the progress bar
+        dirs = self._list_folders(path)
+        total = len(dirs)*2
 
         # Generate name of partition file
         if self.output.endswith("/"):
@@ -241,39 +365,76 @@ class ap_analyses:
         else:
             output_name = self.output.split("/")[-1]
 
-        # Open partition file and write header line
-        with open(f"{self.output}/{output_name}.nex", "w") as partition_file:
-            partition_file.write("#nexus\nbegin sets;\n")
-            # For each folder within Models, get names of files
-            for progress, dir in enumerate(os.listdir(path), 1):
-                dir_name = dir.split("/")[-1]
-                if self.mode == "genome":
-                    file_name = f"{dir.split('/')[-1]}_trimmed.fna"
-                elif self.mode == "proteins":
-                    file_name = f"{dir.split('/')[-1]}_trimmed.faa"
-                # Write path to file in partition file
-                partition_file.write(
-                    f"\tcharset {dir_name} = "\
-                    f"Models/{file_name.split('_')[0]}/{file_name}: *;\n")
-                # Read best model from .iqtree file and store in dictionary
-                with open(f"{path}/{dir_name}/{file_name}.iqtree", 
-                          "r") as models:
-                    for line in models:
-                        if "BIC:" in line:
-                            model_dict[dir] = (line.split(": ")[1])\
-                                .replace("\n", "")
-                # Update progress bar
-                progress_bar(progress, len(os.listdir(path))*2)
-
-            partition_file.write("\tcharpartition mine = ")
-
-            # For each dictionary entry, write used model to partition file
+        # For each folder within Models, get names of files
+        if self.mode == "genome":
+            file_names = [f"{dir}_trimmed.fna" for dir in dirs]
+        elif self.mode == "proteins":
+            file_names = [f"{dir}_trimmed.faa" for dir in dirs]
+
+        # Collect contents of partition file, starting with the header line
+        parts = ["#nexus\nbegin sets;\n"]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=16) \
+                as executor:
+                # Read best models from .iqtree files concurrently
+                iqtree_files = [f"{path}/{dir}/{file_name}.iqtree" \
+                                for dir, file_name in zip(dirs, file_names)]
+                models = executor.map(self._read_model, iqtree_files)
+                for progress, (dir, file_name, model) in enumerate(
+                    zip(dirs, file_names, models), 1):
+                    # Add path to file to partition file
+                    parts.append(
+                        f"\tcharset {dir} = "\
+                        f"Models/{file_name.split('_')[0]}/{file_name}: *;\n")
+                    # Store best model in dictionary
+                    if model is not None:
+                        model_dict[dir] = model
+                    # Update progress bar
+                    progress_bar(progress, total)
+
+            parts.append("\tcharpartition mine = ")
+
+            # For each dictionary entry, add used model to partition file
             for progress, (key, value) in enumerate(model_dict.items(), 
                                                     progress+1):
-                partition_file.write(f"{value}:{key}, ")
-                progress_bar(progress, len(os.listdir(path))*2)
-            partition_file.write(";\nend;")
-            print("\n")
+                parts.append(f"{value}:{key}, ")
+                progress_bar(progress, total)
+            parts.append(";\nend;")
+        finally:
+            # Write partition file at once, also when reading a model fails
+            # so the contents collected so far are kept
+            with open(f"{self.output}/{output_name}.nex", 
+                      "w") as partition_file:
+                partition_file.write("".join(parts))
+        print("\n")
+
+    @staticmethod
+    def _read_model(iqtree_file: str) -> str:
+        """Read the best model according to BIC from an iqtree file.
+
+        Args:
+            iqtree_file (str): Path to the .iqtree file.
+
+        Returns:
+            str: Name of the best model, None if no model was found.
+        """
+        with open(iqtree_file, "rb") as handle:
+            # Empty files cannot be memory mapped and contain no model
+            if os.fstat(handle.fileno()).st_size == 0:
+                return None
+            # Search the memory mapped file for the first BIC line
+            with mmap.mmap(handle.fileno(), 0, 
+                           access=mmap.ACCESS_READ) as models:
+                found = models.find(b"BIC:")
+                if found == -1:
+                    return None
+                start = models.rfind(b"\n", 0, found) + 1
+                end = models.find(b"\n", found)
+                if end == -1:
+                    end = len(models)
+                line = models[start:end].decode()
+
+        return line.partition(": ")[2].rstrip()
 
     def BUSCO_qc(self) -> dict:
         """Determine BUSCO completeness of genomes
@@ -286,13 +447,18 @@ class ap_analyses:
 
         # Get path of BUSCO outputs and create list of folders
         path = f"{self.output}BUSCO_output/"
-        folders = os.listdir(path)
+        folders = self._list_folders(path)
         # Retrieve BUSCO completeness from analyses
         for folder in folders:
-            for file in glob.glob(f"{path}/{folder}/*txt"):
+            with os.scandir(f"{path}/{folder}") as entries:
+                summaries = [entry.path for entry in entries \
+                             if entry.name.endswith("txt") \
+                             and not entry.name.startswith(".")]
+            for file in summaries:
                 with open(file, "r") as summary:
-                    completeness = summary.readlines()[8].split(":")[1]\
-                        .split("%")[0]
+                    # Only read up to the line containing the completeness
+                    line = next(itertools.islice(summary, 8, 9))
+                    completeness = line.split(":")[1].split("%")[0]
                     comp_dict[folder] = float(completeness)
 
         return comp_dict
@@ -322,30 +488,26 @@ class ap_analyses:
         frame_width = width + len(max([str(value) for value in \
                                        qc_dict.values()], key=len)) + 9
         
-        # Print header
-        print(f"{' '*((frame_width-28)//2)}BUSCO COMPLETENESS OF GENOMES")
-
-        # Print top part of window
-        print(f"+{'-'*(frame_width)}+")
+        # Header and top part of window
+        lines = [f"{' '*((frame_width-28)//2)}BUSCO COMPLETENESS OF GENOMES",
+                 f"+{'-'*(frame_width)}+"]
         # For each genome, determine if the quality score reaches a threshold
         # and colour accordingly.
         for key, val in qc_dict.items():
             if val >= threshold[0]:
-                print(f"|  {colours['g'][0]}{key}"\
-                        f"{4*' ' + ' '*(width-len(key))}"\
-                        f"{val}%{colours['g'][1]}  |")
-            if val >= threshold[1] and val < threshold[0]:
-                print(f"|  {colours['y'][0]}{key}"\
-                        f"{4*' ' + ' '*(width-len(key))}"\
-                        f"{val}%{colours['y'][1]}  |")
-            if val < threshold[1]:
+                colour = colours["g"]
+            elif val >= threshold[1]:
+                colour = colours["y"]
+            else:
+                colour = colours["r"]
                 if self.complete != 0.:
                     remove_list.append(key)
-                print(f"|  {colours['r'][0]}{key}"\
-                        f"{4*' ' + ' '*(width-len(key))}"\
-                        f"{val}%{colours['r'][1]}  |")
+            lines.append(f"|  {colour[0]}{key:<{width}}    "\
+                         f"{val}%{colour[1]}  |")
         # Lower part of window
-        print(f"+{'-'*(frame_width)}+\n")
+        lines.append(f"+{'-'*(frame_width)}+\n")
+        # Print the window at once
+        sys.stdout.write("\n".join(lines) + "\n")
 
         # If files need to be skipped, print names.
         if self.complete != 0. and len(remove_list) > 0:
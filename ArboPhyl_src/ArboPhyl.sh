@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# Make conda activate available without starting an interactive shell
+eval "$(conda shell.bash hook)"
+
 # Function generating progress bar of analyses
 function progress_bar(){
 	progress=$1
@@ -85,13 +88,26 @@ if [[ "$1" == "iqtree_models" ]]; then
     next_folder=0
     echo "Running IQTREE Model Prediction..."
     echo
+    running=0
     for dir in *
     do
+        # Wait for a model prediction to finish when all jobs are running
+        if [[ $running -ge $4 ]]; then
+            wait -n
+            running=$((running - 1))
+            next_folder=$((next_folder + 1))
+            progress_bar $next_folder $total_folder
+        fi
+        (cd $dir && iqtree -s *.f* -m MF -nt $3 -quiet) &
+        running=$((running + 1))
+    done
+    # Wait for the remaining model predictions
+    while [[ $running -gt 0 ]]
+    do
+        wait -n
+        running=$((running - 1))
         next_folder=$((next_folder + 1))
-        cd $dir
-        iqtree -s *.f* -m MF -nt $3 -quiet
         progress_bar $next_folder $total_folder
-        cd ..
     done
     echo
     echo
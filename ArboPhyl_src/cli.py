@@ -4,7 +4,9 @@
 """
 
 """Import Statements"""
-from .ArboPhyl import *
+from .ArboPhyl import ap_analyses
+import os
+import sys
 import subprocess
 import argparse
 from argparse import RawTextHelpFormatter
@@ -19,6 +21,12 @@ def main():
                             "For more information see: "\
                             "https://github.com/WesterdijkInstitute/ArboPhyl",
                             formatter_class=RawTextHelpFormatter)
+    # From Python 3.14 on, every added argument creates new help formatters
+    # which each check the colour settings of the terminal. Reuse a single
+    # formatter while adding the arguments.
+    if sys.version_info >= (3, 14):
+        formatter = argParser._get_formatter()
+        argParser._get_formatter = lambda: formatter
     argParser.add_argument("-i",
                            "--input",
                            type=str,
@@ -72,8 +80,22 @@ def main():
                            type=str,
                            help="Number of CPUs for analyses, default: auto",
                            required=False)
+    argParser.add_argument("-j",
+                           "--jobs",
+                           type=int,
+                           help="Number of IQTREE model predictions running "\
+                            "in parallel, default: number of CPUs divided by "\
+                            "threads (1 if threads are not set or auto)",
+                           required=False)
+
+    # Restore creation of new formatters for the help message
+    if sys.version_info >= (3, 14):
+        del argParser._get_formatter
 
     args = argParser.parse_args()
+    # Keep submitted threads, stages below replace missing ones with their
+    # own defaults
+    user_threads = args.threads
     # Default parameter for shared BUSCOs & BUSCO completeness
     if not args.shared:
         args.shared = 100.
@@ -82,7 +104,7 @@ def main():
     
     # Make sure each analysis runs only once, and split input
     args.pipeline = args.pipeline.split(",")
-    if args.pipeline.__contains__("0"):
+    if "0" in args.pipeline:
         args.pipeline = "0"
     # Make sure no letters are submitted
     try:
@@ -92,11 +114,23 @@ def main():
         print("\033[1;31mPlease select a valid pipeline option!\033[00m\n")
         exit()
 
+    # Threads and jobs need to be positive numbers
+    if user_threads and user_threads.lstrip("-").isdigit() \
+        and int(user_threads) < 1:
+        print("\033[1;31mPlease select a positive number of threads!"\
+              "\033[00m\n")
+        exit()
+    if args.jobs is not None and args.jobs < 1:
+        print("\033[1;31mPlease select a positive number of jobs!\033[00m\n")
+        exit()
+
+    # Set of submitted modules for constant time lookups
+    pipeline = set(args.pipeline)
+    run_all = "0" in pipeline
+
     # BUSCO parameters are required
     if not args.lineage:
-        if  args.pipeline.__contains__("0") \
-            or args.pipeline.__contains__("1") \
-            or args.pipeline.__contains__("6"):
+        if run_all or "1" in pipeline or "6" in pipeline:
             print("\033[93m!!! BUSCO related parameter required " \
                   "(lineage) !!!\033[00m")
             exit()
@@ -106,60 +140,66 @@ def main():
 
     # Shared percentage is required
     if not args.shared:
-        if args.pipeline.__contains__("0") \
-        or args.pipeline.__contains__("2"):
+        if run_all or "2" in pipeline:
             print("\033[93m!!! Shared percentage required !!!\033[00m")
             exit()            
 
     # Run modules submitted in pipeline
     # Run BUSCO
-    if args.pipeline.__contains__("0") or args.pipeline.__contains__("1"):
+    if run_all or "1" in pipeline:
         if not args.threads:
             args.threads = "1"
-        print(subprocess.run(["bash", "-i", "ArboPhyl.sh", "busco", 
+        print(subprocess.run(["bash", "ArboPhyl.sh", "busco", 
                               args.input, args.output, args.mode, 
                               args.lineage, args.threads]))
     
     # Run Filter BUSCOs
-    if args.pipeline.__contains__("0") or args.pipeline.__contains__("2"):
-        busco_dict = ap_analyses(output=args.output, 
-                                mode=args.mode,
-                                complete=args.complete).get_BUSCOs()
-        ap_analyses(complete=args.complete)\
-            .BUSCO_qc_screen(ap_analyses(output=args.output).BUSCO_qc())
-        ap_analyses(output=args.output, shared=args.shared, mode=args.mode)\
-            .filter_BUSCOs(ap_analyses.get_Overlap(busco_dict), busco_dict)
+    if run_all or "2" in pipeline:
+        # Use all CPUs for filtering unless a number of threads is given
+        threads = int(user_threads) if user_threads \
+                  and user_threads.isdigit() else None
+        analyses = ap_analyses(output=args.output, mode=args.mode,
+                               shared=args.shared, complete=args.complete,
+                               threads=threads)
+        busco_dict = analyses.get_BUSCOs()
+        analyses.BUSCO_qc_screen(analyses.BUSCO_qc())
+        analyses.filter_BUSCOs(ap_analyses.get_Overlap(busco_dict), busco_dict)
         
     # Run MAFFT Multiple sequence alignment
-    if args.pipeline.__contains__("0") or args.pipeline.__contains__("3"):
+    if run_all or "3" in pipeline:
         if not args.threads:
             args.threads = "-1"
         os.makedirs(os.path.dirname(f"{args.output}/MAFFT_output/"), 
                     exist_ok=True)
-        print(subprocess.run(["bash", "-i", "ArboPhyl.sh", "mafft", 
+        print(subprocess.run(["bash", "ArboPhyl.sh", "mafft", 
                               args.output, args.threads]))
     
     # Run TrimAl on MSAs
-    if args.pipeline.__contains__("0") or args.pipeline.__contains__("4"):
-        print(subprocess.run(["bash", "-i", "ArboPhyl.sh", "trimal", 
+    if run_all or "4" in pipeline:
+        print(subprocess.run(["bash", "ArboPhyl.sh", "trimal", 
                               args.output]))
 
     # Run IQTREE model finder    
-    if args.pipeline.__contains__("0") or args.pipeline.__contains__("5"):
+    if run_all or "5" in pipeline:
         if not args.threads:
             args.threads = "AUTO"
-        print(subprocess.run(["bash", "-i", "ArboPhyl.sh", "iqtree_models",
-                              args.output, args.threads]))
+        # Divide CPUs over the model predictions unless IQTREE selects the
+        # number of threads itself
+        if not args.jobs:
+            args.jobs = max(1, (os.cpu_count() or 1) // int(user_threads)) \
+                        if user_threads and user_threads.isdigit() else 1
+        print(subprocess.run(["bash", "ArboPhyl.sh", "iqtree_models",
+                              args.output, args.threads, str(args.jobs)]))
     
     # Create partition file
-    if args.pipeline.__contains__("0") or args.pipeline.__contains__("6"):
+    if run_all or "6" in pipeline:
         ap_analyses(output=args.output, mode=args.mode).create_partition()
 
     # Run IQTREE 
-    if args.pipeline.__contains__("0") or args.pipeline.__contains__("7"):
+    if run_all or "7" in pipeline:
         if not args.threads:
             args.threads = "AUTO"
-        print(subprocess.run(["bash", "-i", "ArboPhyl.sh", "iqtree",
+        print(subprocess.run(["bash", "ArboPhyl.sh", "iqtree",
                               args.output, args.threads]))
     
     title()
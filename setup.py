@@ -22,7 +22,6 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     scripts=["ArboPhyl_src/ArboPhyl.sh"],
-    install_requires=["Bio"],
     packages=setuptools.find_packages(),
     python_requires=">=3.10",
     entry_points={